@@ -1,11 +1,18 @@
 import discord
 import os
 from visabot.visabot import VisaBot
-from visabot.keep_alive import keep_alive
+
+try:
+    import uvloop
+except ImportError:  # uvloop isn't available on Windows.
+    uvloop = None
 
 if __name__ == '__main__':
+    if uvloop:
+        uvloop.install()
     password = os.getenv('VISABOT_SECRET')
-    client = VisaBot(command_prefix='!')
+    # Only hosts that idle inactive processes (Heroku, Replit) need the keep-alive endpoint.
+    keep_alive = bool(os.getenv('DYNO') or os.getenv('REPL_ID'))
+    client = VisaBot(command_prefix='!', keep_alive=keep_alive)
     print('Using discord.py version {}'.format(discord.__version__))
-    keep_alive()
     client.run(password)
@@ -1,24 +1,44 @@
+import contextlib
 import os
 
-from flask import Flask
-from threading import Thread
+import uvicorn
+from starlette.applications import Starlette
+from starlette.responses import PlainTextResponse
+from starlette.routing import Route
 
-app = Flask('VisaBot')
 
+async def home(request):
+    return PlainTextResponse("I'm alive")
 
-@app.route('/')
-def home():
-    return "I'm alive"
+
+app = Starlette(routes=[Route('/', home)])
 
 
 def get_heroku_port(default=8080):
     return int(os.environ.get('PORT', default))
 
 
-def run():
-    app.run(host='0.0.0.0', port=get_heroku_port())
+class _EmbeddedServer(uvicorn.Server):
+    """
+    A uvicorn server which runs on an existing event loop and leaves signal
+    handling to its owner.
+    """
+
+    def install_signal_handlers(self):
+        pass
+
+    @contextlib.contextmanager
+    def capture_signals(self):
+        yield
 
 
-def keep_alive():
-    t = Thread(target=run)
-    t.start()
+async def serve():
+    """
+    Serves the keep-alive app on the running event loop until cancelled. A
+    failure to start only stops the keep-alive, never the bot sharing the loop.
+    """
+    config = uvicorn.Config(app, host='0.0.0.0', port=get_heroku_port(), log_level='warning')
+    try:
+        await _EmbeddedServer(config).serve()
+    except (SystemExit, OSError) as e:  # uvicorn exits if it can't bind the port.
+        print('Keep-alive server stopped: %r' % e)
@@ -1,14 +1,34 @@
 import asyncio
 import datetime as dt
-import pytz
+import heapq
+import itertools
 import discord as dc
 from collections import defaultdict
-from typing import Dict, DefaultDict
+from typing import Dict, DefaultDict, List, Optional, Tuple
 import re
-import nltk
+import time
+from rapidfuzz.distance import Levenshtein
+from zoneinfo import ZoneInfo
 
 # Custom type names and aliases
 RoleName = str
+ChannelName = str
+
+# Quotation marks accepted around a visa role name in the sponsor command.
+_QUOTE_CHARS = '\"ʺ˝ˮ˶״᳓“”‟″‶〃＂'
+_QUOTE_RE = re.compile('[{0}]([^{0}]*)[{0}]'.format(_QUOTE_CHARS))
+
+# Matches a numerical value followed by its time unit, e.g. '1.5 hours'. Values may
+# be signed, use thousands separators ('1,000') or scientific notation ('1e3').
+_DURATION_RE = re.compile(r'(-?(?:\d[\d,]*(?:\.\d*)?|\.\d+)(?:e[+-]?\d+)?)\s*([a-z]+)')
+# Maps each supported time unit to its length in seconds.
+_UNIT_SECS = {
+    'sec': 1, 'secs': 1, 'second': 1, 'seconds': 1,
+    'min': 60, 'mins': 60, 'minute': 60, 'minutes': 60,
+    'hr': 3600, 'hrs': 3600, 'hour': 3600, 'hours': 3600,
+    'day': 86400, 'days': 86400,
+    'week': 604800, 'weeks': 604800,
+}
 
 
 class Visa(object):
@@ -16,12 +36,15 @@ class Visa(object):
     Provides functionality for constructing a visa and querying its validity.
     """
 
+    __slots__ = ('recipient', 'sponsor', 'role', 'expiry', 'expiry_ts')
+
     def __init__(self, recipient: dc.Member, sponsor: dc.Member, role: dc.Role,
                  expiry: dt.datetime):
         self.recipient = recipient
         self.sponsor = sponsor
         self.role = role
         self.expiry = expiry
+        self.expiry_ts = expiry.timestamp()  # POSIX timestamp for cheap comparisons.
 
     def __key(self):
         return self.recipient, self.sponsor, self.expiry, self.role
@@ -31,13 +54,13 @@ class Visa(object):
         """
         Returns True only if this visa's expiry date has passed.
         """
-        return dt.datetime.now() > self.expiry
+        return time.time() > self.expiry_ts
 
     def expiry_to_str(self, zone='US/Eastern'):
         """
         Returns a string representing the expiry date using the given zone.
         """
-        return self.expiry.astimezone(pytz.timezone(zone)).strftime('%c ' + str(zone))
+        return self.expiry.astimezone(ZoneInfo(zone)).strftime('%c ' + str(zone))
 
     def __eq__(self, other):
         if not isinstance(other, Visa):
@@ -67,24 +90,57 @@ class VisaBot(dc.Client):
             message as a command if it is found.
         announcement_channel: The text channel where the bot announces when visas are
             awarded or revoked.
+        keep_alive: If True, the bot also serves a small HTTP endpoint on its event
+            loop so that hosting platforms don't idle the process.
     """
 
-    def __init__(self, command_prefix: str, announcement_channel='visa-status'):
-        super().__init__()
+    # Usage information shown by _help, following the user-specific prompt.
+    _HELP_TEMPLATE = (
+        '{prompt}\n\nUsage:\n\n'
+        'sponsor:\n!sponsor [User] "[Visa Role]" [Duration]\n'
+        'Examples:\n'
+        '\t!sponsor @friend "My Visa Role" 5 minutes\n'
+        '\t!sponsor @friend "My Visa Role" 3 hrs 1 min 30 secs\n'
+        '\t!sponsor @friend "My Visa Role" 1 week, 2 days, 1.5 hours, and 3 seconds\n\n'
+        'openvisa:\n!openvisa'
+    )
+
+    def __init__(self, command_prefix: str, announcement_channel='visa-status', keep_alive=False):
+        # Only subscribe to the gateway events the bot actually handles.
+        super().__init__(intents=dc.Intents(guilds=True, guild_messages=True, message_content=True,
+                                            members=True))
+        self.keep_alive = keep_alive
+        self._keep_alive_task: Optional[asyncio.Task] = None
         self._visa_sponsor_roles: Dict[RoleName, RoleName] = {}
         self.command_prefix = command_prefix
         self.announcement_channel = announcement_channel
         self._visas: DefaultDict[dc.Role, Dict[dc.Member, Visa]] = defaultdict(dict)
+        # Min-heap of (expiry timestamp, tiebreaker, visa) with a single timer for its head.
+        self._visa_heap: List[Tuple[float, int, Visa]] = []
+        self._visa_counter = itertools.count()
+        self._expiry_handle: Optional[asyncio.TimerHandle] = None
+        self._role_cache: Dict[Tuple[int, RoleName], dc.Role] = {}
+        self._channel_cache: Dict[Tuple[int, ChannelName], dc.abc.GuildChannel] = {}
         self._cmd_handlers = {  # Map actions to their respective handlers.
             'sponsor': self._action_sponsor,
             'openvisa': self._action_openvisa,
             'closevisa': self._action_closevisa
         }
 
+    async def setup_hook(self):
+        """Override."""
+        # Runs once after login, before the gateway connects, so the keep-alive port is
+        # bound without waiting for the bot to become ready.
+        if self.keep_alive:
+            from visabot.keep_alive import serve  # Only pull in the web stack when it's used.
+            self._keep_alive_task = self.loop.create_task(serve())
+
     async def on_ready(self):
         """Override."""
         print('Logged in as {0.user}'.format(self))
-        self.loop.create_task(self._poll_visas())
+        # Updates missed while disconnected never reach the invalidation handlers.
+        self._role_cache.clear()
+        self._channel_cache.clear()
 
     async def on_message(self, message: dc.Message):
         """Override."""
@@ -92,21 +148,53 @@ class VisaBot(dc.Client):
             return
         await self._parse_command(message)
 
+    async def on_guild_role_update(self, before: dc.Role, after: dc.Role):
+        """Override."""
+        self._role_cache.pop((before.guild.id, before.name), None)
+
+    async def on_guild_role_delete(self, role: dc.Role):
+        """Override."""
+        self._role_cache.pop((role.guild.id, role.name), None)
+
+    async def on_guild_channel_update(self, before: dc.abc.GuildChannel,
+                                      after: dc.abc.GuildChannel):
+        """Override."""
+        self._channel_cache.pop((before.guild.id, before.name), None)
+
+    async def on_guild_channel_delete(self, channel: dc.abc.GuildChannel):
+        """Override."""
+        self._channel_cache.pop((channel.guild.id, channel.name), None)
+
+    def _get_role(self, guild: dc.Guild, name: RoleName) -> Optional[dc.Role]:
+        """
+        Looks up a guild's role by name, caching the result of the search.
+        """
+        key = (guild.id, name)
+        role = self._role_cache.get(key)
+        if role is None:
+            role = dc.utils.get(guild.roles, name=name)
+            if role is not None:
+                self._role_cache[key] = role
+        return role
+
+    def _get_channel(self, guild: dc.Guild, name: ChannelName) -> Optional[dc.abc.GuildChannel]:
+        """
+        Looks up a guild's channel by name, caching the result of the search.
+        """
+        key = (guild.id, name)
+        channel = self._channel_cache.get(key)
+        if channel is None:
+            channel = dc.utils.get(guild.channels, name=name)
+            if channel is not None:
+                self._channel_cache[key] = channel
+        return channel
+
     async def _help(self, message: dc.Message, err=''):
         """
         Provides help and usage information for the user commanding the bot.
         """
         prompt = err if err else 'I don\'t understand what you said :('
-
-        sponsor_fmt = 'sponsor:\n!sponsor [User] "[Visa Role]" [Duration]'
-        ex_1 = '!sponsor @friend "My Visa Role" 5 minutes'
-        ex_2 = '!sponsor @friend "My Visa Role" 3 hrs 1 min 30 secs'
-        ex_3 = '!sponsor @friend "My Visa Role" 1 week, 2 days, 1.5 hours, and 3 seconds'
-        sponsor_usage = '{}\nExamples:\n\t{}\n\t{}\n\t{}'.format(sponsor_fmt, ex_1, ex_2, ex_3)
-
-        openvisa_usage = 'openvisa:\n!openvisa'
-
-        msg = '{}\n\nUsage:\n\n{}\n\n{}'.format(prompt, sponsor_usage, openvisa_usage)
+        msg = self._HELP_TEMPLATE.format(prompt=prompt)
         await message.channel.send(msg)
         print('Help requested for message: \"%s\"' % message.content)
 
@@ -117,18 +205,24 @@ class VisaBot(dc.Client):
         the user.
         """
         command = message.content
-        action = command.split()[0][1:]  # gets action and removes the command prefix
         if not command.startswith(self.command_prefix):
             return
-        if action in self._cmd_handlers:
-            self.loop.create_task(self._cmd_handlers[action](message))
+        # Splits the command once; the handlers receive its tokens.
+        parts = command.split(maxsplit=2)
+        action = parts[0][len(self.command_prefix):]  # Removes the command prefix.
+        handler = self._cmd_handlers.get(action)
+        if handler is not None:
+            self.loop.create_task(handler(message, parts))
         else:  # If the action edit distance is small, ask for clarification.
             MAX_DISTANCE = 2
             for key in self._cmd_handlers.keys():
-                if nltk.edit_distance(action, key) <= MAX_DISTANCE:
+                # The edit distance is at least the difference in length.
+                if abs(len(action) - len(key)) > MAX_DISTANCE:
+                    continue
+                if Levenshtein.distance(action, key, score_cutoff=MAX_DISTANCE) <= MAX_DISTANCE:
                     await self._help(message, 'Did you mean to use !%s?' % key)
 
-    async def _action_sponsor(self, message: dc.Message):
+    async def _action_sponsor(self, message: dc.Message, parts: List[str]):
         """
         Handles the administration of visas from a sponsor to a tourist.
         """
@@ -138,17 +232,16 @@ class VisaBot(dc.Client):
             Regex helper which extracts the first string in 'content' surrounded
             by quotes.
             """
-            quote_chars = '\"ʺ˝ˮ˶״᳓“”‟″‶〃＂'
-            group = re.findall('[{0}](.*)[{0}]'.format(quote_chars), content)
-            if len(group) == 0:
+            match = _QUOTE_RE.search(content)
+            if not match:
                 raise ValueError('Could not find a quoted string!')
-            return group[0]
+            return match.group(1)
 
         # Parse the command's tokens.
-        _, tourist, rest = message.content.split(maxsplit=2)
+        _, tourist, rest = parts
         try:
             visa_rolename = _re_extract_from_quotes(rest)
-            visa_role = dc.utils.get(message.guild.roles, name=visa_rolename)
+            visa_role = self._get_role(message.guild, visa_rolename)
         except ValueError:
             await self._help(message, 'The visa role needs to be surrounded by quotes!')
             return
@@ -179,7 +272,7 @@ class VisaBot(dc.Client):
         except ValueError as e:
             await self._help(message, str(e))
 
-    async def _action_openvisa(self, message: dc.Message):
+    async def _action_openvisa(self, message: dc.Message, parts: List[str]):
         """
         Opens a sponsor/tourist relationship between two roles.
         """
@@ -201,12 +294,12 @@ class VisaBot(dc.Client):
         # Map the sponsor role to the visa role if they are both valid.
         sponsor_rolename, visa_rolename = await _get_roles()
         for role in [sponsor_rolename, visa_rolename]:
-            if not dc.utils.get(message.guild.roles, name=role):
+            if not self._get_role(message.guild, role):
                 await self._help(message, 'The role %s doesn\'t exist' % role)
                 return
         self._visa_sponsor_roles[visa_rolename] = sponsor_rolename
 
-    async def _action_closevisa(self, message):
+    async def _action_closevisa(self, message: dc.Message, parts: List[str]):
         """
         Removes a sponsor/tourist relationship from currently open visas if it exists.
         """
@@ -218,42 +311,79 @@ class VisaBot(dc.Client):
 
     async def _approve_visa(self, visa: Visa):
         """
-        Gives the user a visa role and updates the internal collection
-        of visas.
+        Gives the user a visa role, updates the internal collection
+        of visas and schedules the visa's expiry.
         """
-        await visa.recipient.add_roles(visa.role)
+        channel = self._get_channel(visa.recipient.guild, self.announcement_channel)
+        msg = '{}\'s visa will expire on {}'.format(visa.recipient.mention,
+                                                    visa.expiry_to_str('US/Eastern'))
+        add_res, send_res = await asyncio.gather(visa.recipient.add_roles(visa.role),
+                                                 channel.send(msg), return_exceptions=True)
+        if isinstance(add_res, BaseException):
+            raise add_res
+        # The role was granted, so the visa must expire even if the announcement failed.
         self._visas[visa.role][visa.recipient] = visa
-        channel = dc.utils.get(visa.recipient.guild.channels, name=self.announcement_channel)
-        await channel.send('{}\'s visa will expire on {}'.format(visa.recipient.mention,
-                                                                 visa.expiry_to_str('US/Eastern')))
+        heapq.heappush(self._visa_heap, (visa.expiry_ts, next(self._visa_counter), visa))
+        self._schedule_expiry()
+        if isinstance(send_res, BaseException):
+            raise send_res
 
-    async def _poll_visas(self):
+    def _schedule_expiry(self):
+        """
+        Arms a single timer for the visa that expires soonest, replacing any
+        previously armed timer.
+        """
+        if self._expiry_handle:
+            self._expiry_handle.cancel()
+            self._expiry_handle = None
+        if self._visa_heap:
+            delay = self._visa_heap[0][0] - time.time()
+            self._expiry_handle = self.loop.call_later(
+                delay, lambda: self.loop.create_task(self._expire_visas()))
+
+    async def _expire_visas(self):
         """
-        Indefinitely polls the active visas, checking if any have expired.
-        If a visa has expired, the member's visa role is removed and the
-        server is notified.
+        Pops every expired visa off the heap, dropping it from the internal
+        collection of visas, re-arms the timer for the next visa and retires
+        the expired visas concurrently, one batch per member. Visas which have
+        since been superseded by a newer one are discarded.
         """
-        POLL_TICK_SECS = 1
-        while True:
-            await self.wait_until_ready()
-            expired = set()
-            for role_visas in self._visas.keys():
-                for recipient, visa in self._visas[role_visas].items():
-                    if not visa.is_expired:
-                        continue
-                    await recipient.remove_roles(visa.role)
-                    channel = dc.utils.get(recipient.guild.channels, name=self.announcement_channel)
-                    await channel.send('{}\'s visa has expired!'.format(recipient.mention))
-                    expired.add(recipient)
-                for recipient in expired:
-                    del self._visas[role_visas][recipient]
-            await asyncio.sleep(POLL_TICK_SECS)
+        now = time.time()
+        expired: DefaultDict[Tuple[int, int], List[Visa]] = defaultdict(list)
+        while self._visa_heap and self._visa_heap[0][0] <= now:
+            _, _, visa = heapq.heappop(self._visa_heap)
+            role_visas = self._visas[visa.role]
+            if role_visas.get(visa.recipient) is visa:
+                del role_visas[visa.recipient]
+                expired[visa.recipient.guild.id, visa.recipient.id].append(visa)
+        self._schedule_expiry()
+        batches = list(expired.values())
+        results = await asyncio.gather(*(self._expire_member_visas(visas) for visas in batches),
+                                       return_exceptions=True)
+        for visas, result in zip(batches, results):  # One member's failure shouldn't hide others.
+            if isinstance(result, BaseException):
+                print('Failed to expire visas for %s: %r' % (visas[0].recipient, result))
+
+    async def _expire_member_visas(self, visas: List[Visa]):
+        """
+        Removes the roles of a member's expired visas and notifies the server
+        with a single message naming them.
+        """
+        recipient = visas[0].recipient
+        # Removes only the expired roles, leaving any others granted meanwhile untouched.
+        role_change = recipient.remove_roles(*(visa.role for visa in visas))
+        requests = [role_change]
+        channel = self._get_channel(recipient.guild, self.announcement_channel)
+        if channel is not None:  # The announcement channel may have been renamed or deleted.
+            role_names = ', '.join('"%s"' % visa.role.name for visa in visas)
+            requests.append(channel.send('{}\'s visa for {} has expired!'.format(recipient.mention,
+                                                                               role_names)))
+        await asyncio.gather(*requests)
 
 
 def parse_duration(duration: str):
     """
-    Parses a string describing a duration. No time will be added
-    if the time unit is invalid.
+    Parses a string describing a duration.
 
     Args:
         duration: A string describing a duration in a human-readable format.
@@ -262,7 +392,8 @@ def parse_duration(duration: str):
         A datetime.timedelta describing the parsed duration.
 
     Raises:
-        ValueError: A time unit (following a numerical value) in 'duration' is not supported.
+        ValueError: A time unit (following a numerical value) in 'duration' is not supported,
+            or 'duration' doesn't describe a positive amount of time.
 
     Examples:
         parse_duration('5 minutes')
@@ -272,29 +403,12 @@ def parse_duration(duration: str):
         parse_duration('3 weeks, 2 days, 1.5 hours, 1 second')
             -> timedelta(weeks=1, days=2, hours=1.5, seconds=3)
     """
-    SECOND_STRINGS = {'sec', 'secs', 'second', 'seconds'}
-    MINUTE_STRINGS = {'min', 'mins', 'minute', 'minutes'}
-    HOUR_STRINGS = {'hr', 'hrs', 'hour', 'hours'}
-    DAY_STRINGS = {'day', 'days'}
-    WEEK_STRINGS = {'week', 'weeks'}
-    tokens = duration.lower().replace(',', '').replace('and', '').split()
-    parsed = dt.timedelta(seconds=0)
-    for i, tk in enumerate(tokens):
-        try:
-            val = float(tk)
-        except ValueError:  # Not a number!
-            continue
-        unit = tokens[i + 1]
-        if unit in SECOND_STRINGS:
-            parsed += dt.timedelta(seconds=val)
-        elif unit in MINUTE_STRINGS:
-            parsed += dt.timedelta(minutes=val)
-        elif unit in HOUR_STRINGS:
-            parsed += dt.timedelta(hours=val)
-        elif unit in DAY_STRINGS:
-            parsed += dt.timedelta(days=val)
-        elif unit in WEEK_STRINGS:
-            parsed += dt.timedelta(weeks=val)
-        else:
+    total_secs = 0.0
+    for match in _DURATION_RE.finditer(duration.lower()):
+        unit_secs = _UNIT_SECS.get(match.group(2))
+        if unit_secs is None:
             raise ValueError('Time unit not supported')
-    return parsed
+        total_secs += float(match.group(1).replace(',', '')) * unit_secs
+    if total_secs <= 0:  # Nothing parsed, or the visa would expire immediately.
+        raise ValueError('The visa needs a positive duration, like 5 minutes!')
+    return dt.timedelta(seconds=total_secs)